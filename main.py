@@ -1,47 +1,78 @@
 import streamlit as st
-import json
+import orjson
 import datetime
-from google import genai
-from google.genai import types
+import collections
+import time
+import re
+from operator import itemgetter
 import typing 
-import pandas as pd # Pandasをインポート (st.dataframeで便利に使うため)
+
+# google-genai is imported lazily inside the functions that use it, so page renders
+# that never call the API do not pay for loading the SDK.
+if typing.TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
 
 # --- 1. Constants and Initial Configuration ---
 
 MODEL_NAME = "gemini-2.5-flash"  # Use a fast model for general processing
 
-# The prompt template instructs Gemini on what to extract and the required output format (JSON).
-PROMPT_TEMPLATE = """
-Extract the order information from the email body provided below and strictly follow the specified JSON schema for output.
-Use null for any item that does not exist.
+# Several pasted emails are separated by a line consisting of exactly this marker. A bare run of
+# "=" or "-" cannot be used: order emails commonly contain such rules, as the sample does with "---".
+EMAIL_SEPARATOR = "===== EMAIL ====="
+_EMAIL_SEPARATOR_PATTERN = re.compile(r"^[ \t]*" + re.escape(EMAIL_SEPARATOR) + r"[ \t]*$", re.MULTILINE)
 
-# Email Body
----
-{email_body}
----
-
-# JSON Schema
-{{
-  "order_id": "string (e.g.: PO-20250901)",
-  "order_date": "string (e.g.: 2025-09-01)",
-  "customer_name": "string",
-  "total_amount": "integer (amount as number only)",
-  "delivery_address": "string",
-  "items": [
-    {{
-      "product_name": "string",
-      "quantity": "integer",
-      "unit_price": "integer"
-    }}
-  ]
-}}
+# The prompt pieces instruct Gemini on what to extract; the output format comes from the response schema.
+# All emails go out in one request, one numbered block each, so N emails cost a single round-trip.
+# The pieces are joined by plain concatenation, so building a prompt needs no str.format parsing.
+_PROMPT_HEAD = "\nExtract the order information from each of the "
+_PROMPT_INSTRUCTIONS = """ email bodies provided below.
+Return one order per email, in the same order as the emails.
+Use null for any item that does not exist.
 """
+_EMAIL_BLOCK_HEAD = "\n# Email Body "
+_EMAIL_BLOCK_FENCE = "\n---\n"
+
+# While the response streams in, the preview shows only its tail and is refreshed at most this often,
+# so rendering cost stays bounded instead of resending the whole buffer for every chunk.
+_STREAM_PREVIEW_INTERVAL = 0.25  # seconds
+_STREAM_PREVIEW_CHARS = 2000
+
+# Scalar order fields, fetched together with a single C-level itemgetter call.
+_ORDER_FIELDS = ('order_id', 'order_date', 'customer_name', 'total_amount', 'delivery_address')
+_get_order_fields = itemgetter(*_ORDER_FIELDS)
+
+_HISTORY_COLUMN_ORDER = ("Order ID", "Internal Tracking No.", "Customer Name", "Order Date", "Total Amount", "Delivery Address", "Extraction Time")
+
+# Table column settings. Streamlit re-executes this script on every rerun, so the configs are
+# built by cached getters (once per process, and only when a table is actually rendered).
+@st.cache_resource(show_spinner=False)
+def _get_items_column_config() -> dict:
+    """Returns the currency formatting for the item details table."""
+    return {
+        "unit_price": st.column_config.NumberColumn("Unit Price", format="¥%,d"),
+        "Subtotal": st.column_config.NumberColumn("Subtotal", format="¥%,d"),
+    }
+
+@st.cache_resource(show_spinner=False)
+def _get_history_column_config() -> dict:
+    """Returns the currency formatting for the order history table."""
+    return {
+        "Total Amount": st.column_config.NumberColumn("Total Amount", format="¥%,d")
+    }
 
 # --- 2. Session State Initialization ---
 
 # Initialize core variables in Streamlit's session_state for persistence across reruns.
-if 'orders' not in st.session_state:
-    st.session_state.orders = []
+# Saved orders are stored column-wise: one deque per field, all sharing the same row index.
+# Rows are kept newest first, so the history table can be displayed without reordering.
+_ORDER_COLUMNS = ("order_ids", "tracking_numbers", "order_dates", "customer_names", "total_amounts", "delivery_addresses", "extraction_times")
+for column in _ORDER_COLUMNS:
+    if column not in st.session_state:
+        st.session_state[column] = collections.deque()
+# Set of saved order IDs for O(1) duplicate checks.
+if 'order_id_index' not in st.session_state:
+    st.session_state.order_id_index = set()
 if 'GEMINI_API_KEY' not in st.session_state:
     st.session_state.GEMINI_API_KEY = ""
 if 'recipient_email' not in st.session_state:
@@ -52,55 +83,194 @@ if 'internal_tracking_counter' not in st.session_state:
 
 # --- 3. Data Saving Function (using Session State) ---
 
+def normalize_order_fields(extracted_data: dict, default=None) -> tuple:
+    """Returns the values of _ORDER_FIELDS in order, using default for any field missing from the extracted data."""
+    # The response schema makes every field required (null when absent), so the single itemgetter
+    # call normally succeeds; only a malformed response falls back to per-field lookups.
+    try:
+        return _get_order_fields(extracted_data)
+    except KeyError:
+        return tuple(extracted_data.get(field, default) for field in _ORDER_FIELDS)
+
 def save_order_to_state(extracted_data: dict) -> typing.Tuple[bool, str]:
     """Saves the extracted order information to the session state and assigns a unique internal tracking number."""
     
     order_id = extracted_data.get('order_id')
     
-    # Check for duplicate order ID.
-    if any(order['order_id'] == order_id for order in st.session_state.orders):
+    # Check for duplicate order ID before doing any other work, so duplicates cost a single lookup
+    # and never consume an internal tracking number.
+    if order_id in st.session_state.order_id_index:
         st.warning(f"⚠️ **Order ID: {order_id}** already exists in the session.")
         return False, "Not Assigned (Duplicate Order)"
     
+    _, order_date, customer_name, total_amount, delivery_address = normalize_order_fields(extracted_data)
+    
     # --- Internal Tracking Number Generation (Unique Auto-Numbering) ---
     st.session_state.internal_tracking_counter += 1
     internal_tracking_number = f"ITN-{st.session_state.internal_tracking_counter:07d}"
     
-    # Construct the data record to be saved.
-    data_to_save = {
-        "order_id": order_id,
-        "internal_tracking_number": internal_tracking_number, 
-        "order_date": extracted_data.get('order_date'),
-        "customer_name": extracted_data.get('customer_name'),
-        "total_amount": extracted_data.get('total_amount'),
-        "delivery_address": extracted_data.get('delivery_address'),
-        "extraction_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "raw_json": extracted_data # Keep the full JSON output
-    }
-    
-    st.session_state.orders.append(data_to_save)
+    # Prepend the record to each column deque (newest first); appendleft is O(1).
+    st.session_state.order_ids.appendleft(order_id)
+    st.session_state.tracking_numbers.appendleft(internal_tracking_number)
+    st.session_state.order_dates.appendleft(order_date)
+    st.session_state.customer_names.appendleft(customer_name)
+    st.session_state.total_amounts.appendleft(total_amount)
+    st.session_state.delivery_addresses.appendleft(delivery_address)
+    st.session_state.extraction_times.appendleft(datetime.datetime.now().isoformat(sep=' ', timespec='seconds'))
+    st.session_state.order_id_index.add(order_id)
     return True, internal_tracking_number
 
+def _build_history_table() -> dict:
+    """Returns the order history table (column name -> values), backed directly by the newest-first column deques."""
+    return {
+        "Order ID": st.session_state.order_ids,
+        "Internal Tracking No.": st.session_state.tracking_numbers,
+        "Order Date": st.session_state.order_dates,
+        "Customer Name": st.session_state.customer_names,
+        "Total Amount": st.session_state.total_amounts,
+        "Delivery Address": st.session_state.delivery_addresses,
+        "Extraction Time": st.session_state.extraction_times,
+    }
+
+def show_order_result(extracted_data: dict, saved_successfully: bool, internal_tracking_number: str) -> None:
+    """Shows the save result for one extracted order, with its notification and item details when it was saved."""
+    # Fetch every field the messages below need in a single pass.
+    order_id, order_date, cust_name, total, delivery_address = normalize_order_fields(extracted_data, 'N/A')
+
+    if saved_successfully:
+        st.success(f"💾 **Order ID: {order_id}** order information saved to session. **Internal Tracking No.: {internal_tracking_number}**")
+
+        # --- Generate Comprehensive Notification Message ---
+        recipient = st.session_state.recipient_email
+        # The amount may be null or missing ('N/A'); only format it as currency when it is a number.
+        total_display = f"¥{total:,}" if isinstance(total, int) else total
+
+        # **すべての抽出情報を含む通知メッセージ**
+        notification_message = f"""
+        🔔 **[New Order Alert] - Internal Tracking No.: {internal_tracking_number}**
+
+        - **Order ID:** **{order_id}**
+        - **Customer:** {cust_name}
+        - **Order Date:** {order_date}
+        - **Total Amount:** **{total_display}**
+        - **Delivery Address:** {delivery_address}
+        - **Notification Recipient (Simulated):** {recipient}
+
+        """
+        st.info(notification_message)
+
+        # --- Display Item Details (All items in JSON) ---
+        st.subheader(f"📦 Item Details (Order ID: {order_id})")
+        items_list = extracted_data.get('items', [])
+
+        if items_list:
+            # Normalize each row to the schema's columns and calculate the subtotal for better display.
+            # Missing or null numbers count as 0 so the subtotal can always be computed.
+            item_rows = []
+            for item in items_list:
+                quantity = item.get('quantity') or 0
+                unit_price = item.get('unit_price') or 0
+                item_rows.append({
+                    "product_name": item.get('product_name'),
+                    "quantity": quantity,
+                    "unit_price": unit_price,
+                    "Subtotal": quantity * unit_price
+                })
+
+            # Format currency columns
+            st.dataframe(
+                item_rows,
+                use_container_width=True,
+                column_config=_get_items_column_config(),
+                hide_index=True
+            )
+        else:
+            st.warning("No item details were extracted.")
+
+    else:
+        # If saving failed (e.g., duplicate order ID)
+        notification_message = f"""
+        ⚠️ **[Order Processing Skipped]** - **Order ID:** {order_id}
+        - **Reason:** Duplicate Order ID found.
+        """
+        st.warning(notification_message)
+
 # --- 4. Gemini Information Extraction Function ---
 
-def extract_order_info(client: genai.Client, email_body: str) -> typing.Optional[dict]:
-    """Uses the Gemini model to extract structured order information from raw text."""
-    prompt = PROMPT_TEMPLATE.format(email_body=email_body)
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> "genai.Client":
+    """Returns the Gemini client for the given API key, shared by all sessions in this process."""
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def _get_gen_config() -> "types.GenerateContentConfig":
+    """Returns the invariant request configuration, built on first extraction and then reused."""
+    import pydantic
+    from google.genai import types
+    
+    # Output structure enforced server-side via response_schema, so it does not have to be spelled out in the prompt.
+    # The models live here rather than at module level so script reruns do not rebuild them.
+    # Fields are required but nullable: schema defaults are rejected by some google-genai versions.
+    class OrderItem(pydantic.BaseModel):
+        product_name: typing.Optional[str]
+        quantity: typing.Optional[int]
+        unit_price: typing.Optional[int]
+
+    class Order(pydantic.BaseModel):
+        order_id: typing.Optional[str] = pydantic.Field(description="e.g.: PO-20250901")
+        order_date: typing.Optional[str] = pydantic.Field(description="e.g.: 2025-09-01")
+        customer_name: typing.Optional[str]
+        total_amount: typing.Optional[int] = pydantic.Field(description="amount as number only")
+        delivery_address: typing.Optional[str]
+        items: typing.List[OrderItem]
+
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=list[Order]
+    )
+
+def split_email_bodies(email_text: str) -> typing.List[str]:
+    """Splits the pasted text into individual email bodies on EMAIL_SEPARATOR lines, dropping empty ones."""
+    return [body.strip() for body in _EMAIL_SEPARATOR_PATTERN.split(email_text) if body.strip()]
+
+def extract_order_info(client: "genai.Client", email_bodies: typing.List[str]) -> typing.Optional[typing.List[dict]]:
+    """Uses the Gemini model to extract structured order information from one or more raw emails in a single request."""
+    from google.genai import types
     
-    config = types.GenerateContentConfig(
-        response_mime_type="application/json"
+    prompt = _PROMPT_HEAD + str(len(email_bodies)) + _PROMPT_INSTRUCTIONS + "".join(
+        _EMAIL_BLOCK_HEAD + str(number) + _EMAIL_BLOCK_FENCE + email_body + _EMAIL_BLOCK_FENCE
+        for number, email_body in enumerate(email_bodies, start=1)
     )
+    # Pass a ready-made Content so the SDK does not have to coerce a bare string.
+    contents = [types.Content(role="user", parts=[types.Part.from_text(text=prompt)])]
 
+    # Stream the response and show the JSON as it arrives, so the wait is visible instead of one blocking call.
+    stream_placeholder = st.empty()
+    response_text = ""
+    last_preview = 0.0
     try:
-        response = client.models.generate_content(
+        for chunk in client.models.generate_content_stream(
             model=MODEL_NAME,
-            contents=[prompt],
-            config=config
-        )
-        return json.loads(response.text)
+            contents=contents,
+            config=_get_gen_config()
+        ):
+            if chunk.text:
+                response_text += chunk.text
+                now = time.monotonic()
+                if now - last_preview >= _STREAM_PREVIEW_INTERVAL:
+                    stream_placeholder.code(response_text[-_STREAM_PREVIEW_CHARS:], language='json')
+                    last_preview = now
+        extracted_orders = orjson.loads(response_text)
+        if not isinstance(extracted_orders, list):
+            st.error(f"Gemini API Extraction Error: expected a list of orders, got {type(extracted_orders).__name__}.")
+            return None
+        return extracted_orders
     except Exception as e:
         st.error(f"Gemini API Extraction Error: {e}")
         return None
+    finally:
+        stream_placeholder.empty()
 
 # --- 5. Streamlit UI and Main Logic ---
 
@@ -122,11 +292,11 @@ with st.sidebar:
         st.session_state.GEMINI_API_KEY = api_key_input
         if st.session_state.GEMINI_API_KEY:
             try:
-                st.session_state['gemini_client'] = genai.Client(api_key=st.session_state.GEMINI_API_KEY)
+                get_client(st.session_state.GEMINI_API_KEY)
                 st.success("Gemini client initialized successfully.")
             except Exception as e:
                 st.error(f"Failed to initialize API Key: {e}")
-                st.session_state['gemini_client'] = None
+                st.session_state.GEMINI_API_KEY = ""
         else:
             st.warning("Please enter the API key.")
 
@@ -148,7 +318,7 @@ with st.sidebar:
 # User Input Area
 st.header("1. Enter Email Body")
 email_input = st.text_area(
-    "Paste the email body containing the order information here:",
+    f"Paste the email body containing the order information here (separate multiple emails with a line containing only {EMAIL_SEPARATOR}):",
     height=300,
     key="email_input",
     value="Subject: Order (Order No: PO-20250901)\n\nTo: XX Trading Co.\n\nThank you for your business. This is Sato from Order Co., Ltd.\nWe would like to place an order as follows:\n\nOrder Date: 2025-09-01\nDelivery Address: Chiyoda-ku, Tokyo, 100-0001\nTotal Amount: 45000\n\n---\nItem: A4 Copy Paper, Quantity: 10, Unit Price: 3000\nItem: Ballpoint Pen Set, Quantity: 5, Unit Price: 3000\n---\n\nThank you for your kind attention.\nFrom: Order Co., Ltd."
@@ -158,88 +328,52 @@ email_input = st.text_area(
 if st.button("🚀 Extract & Process Order Information"):
     
     # Pre-execution checks
-    if 'gemini_client' not in st.session_state or not st.session_state.get('gemini_client'):
+    if not st.session_state.GEMINI_API_KEY:
         st.error("❌ Gemini API Key is not set. Please set the API key in the sidebar.")
         st.stop()
-    if not email_input:
+    email_bodies = split_email_bodies(email_input)
+    if not email_bodies:
         st.warning("Please enter the email body.")
         st.stop()
         
-    client = st.session_state['gemini_client']
+    client = get_client(st.session_state.GEMINI_API_KEY)
         
     st.header("2. Information Extraction by Gemini")
     
-    # --- Extraction Process ---
-    with st.spinner("Gemini is analyzing the email body..."):
-        extracted_data = extract_order_info(client, email_input)
+    # --- Extraction Process (all emails in one request) ---
+    with st.spinner(f"Gemini is analyzing {len(email_bodies)} email body(ies)..."):
+        extracted_orders = extract_order_info(client, email_bodies)
     
-    if extracted_data:
-        st.success("✅ Information extraction successful!")
+    if extracted_orders:
+        st.success(f"✅ Information extraction successful! ({len(extracted_orders)} order(s))")
         st.subheader("Extracted Data (JSON)")
-        st.json(extracted_data)
+        st.json(extracted_orders)
+        if len(extracted_orders) != len(email_bodies):
+            st.warning(f"⚠️ {len(email_bodies)} email(s) were sent but {len(extracted_orders)} order(s) were extracted. Some orders may have been merged or dropped; please check the results.")
         
         # --- Saving to Session State (Generate Internal Number here) ---
         st.header("3. Saving to Session State & Notification")
         
-        # Save and get the internal tracking number
-        saved_successfully, internal_tracking_number = save_order_to_state(extracted_data)
-        
-        order_id = extracted_data.get('order_id', 'N/A')
-
-        if saved_successfully:
-            st.success(f"💾 **Order ID: {order_id}** order information saved to session. **Internal Tracking No.: {internal_tracking_number}**")
-            
-            # --- Generate Comprehensive Notification Message ---
-            cust_name = extracted_data.get('customer_name', 'N/A')
-            total = extracted_data.get('total_amount', 'N/A')
-            order_date = extracted_data.get('order_date', 'N/A')
-            delivery_address = extracted_data.get('delivery_address', 'N/A')
-            recipient = st.session_state.recipient_email
-            
-            # **すべての抽出情報を含む通知メッセージ**
-            notification_message = f"""
-            🔔 **[New Order Alert] - Internal Tracking No.: {internal_tracking_number}**
-            
-            - **Order ID:** **{order_id}**
-            - **Customer:** {cust_name}
-            - **Order Date:** {order_date}
-            - **Total Amount:** **¥{total:,}**
-            - **Delivery Address:** {delivery_address}
-            - **Notification Recipient (Simulated):** {recipient}
-            
-            """
-            st.info(notification_message)
-            
-            # --- Display Item Details (All items in JSON) ---
-            st.subheader("📦 Item Details")
-            items_list = extracted_data.get('items', [])
-            
-            if items_list:
-                df_items = pd.DataFrame(items_list)
-                # Calculate subtotal for better display
-                if 'quantity' in df_items.columns and 'unit_price' in df_items.columns:
-                    df_items['Subtotal'] = df_items['quantity'] * df_items['unit_price']
-                
-                # Format currency columns
-                st.dataframe(
-                    df_items,
-                    use_container_width=True,
-                    column_config={
-                        "unit_price": st.column_config.NumberColumn("Unit Price", format="¥%,d"),
-                        "Subtotal": st.column_config.NumberColumn("Subtotal", format="¥%,d"),
-                    },
-                    hide_index=True
-                )
-            else:
-                st.warning("No item details were extracted.")
-            
-        else:
-            # If saving failed (e.g., duplicate order ID)
-            notification_message = f"""
-            ⚠️ **[Order Processing Skipped]** - **Order ID:** {order_id}
-            - **Reason:** Duplicate Order ID found.
-            """
-            st.warning(notification_message)
+        for number, extracted_data in enumerate(extracted_orders, start=1):
+            # Process each order independently, so one malformed order does not stop the rest of the batch.
+            # Saving and displaying are handled separately, so a display failure is not reported as a lost order.
+            try:
+                order_id = extracted_data.get('order_id')
+                if not order_id:
+                    st.warning(f"⚠️ **[Order Processing Skipped]** - No order ID was extracted for order {number} of {len(extracted_orders)}, so it was not saved.")
+                    continue
+                # Save and get the internal tracking number
+                saved_successfully, internal_tracking_number = save_order_to_state(extracted_data)
+            except Exception as e:
+                st.error(f"Order Processing Error (order {number} of {len(extracted_orders)}): {e}")
+                continue
+            try:
+                show_order_result(extracted_data, saved_successfully, internal_tracking_number)
+            except Exception as e:
+                if saved_successfully:
+                    st.error(f"Order ID {order_id} was saved with Internal Tracking No. {internal_tracking_number}, but displaying it failed: {e}")
+                else:
+                    st.error(f"Order Processing Error (order {number} of {len(extracted_orders)}): {e}")
 
 
 # --- 6. Display Data (For Confirmation) ---
@@ -247,30 +381,15 @@ if st.button("🚀 Extract & Process Order Information"):
 st.markdown("---")
 st.header("📋 Order History Saved in Session")
 
-if st.session_state.orders:
-    # Prepare data for display from the session state list.
-    display_data = []
-    for order in st.session_state.orders:
-        display_data.append({
-            "Order ID": order["order_id"],
-            "Internal Tracking No.": order["internal_tracking_number"],
-            "Order Date": order["order_date"],
-            "Customer Name": order["customer_name"],
-            "Total Amount": order["total_amount"],
-            "Delivery Address": order["delivery_address"], # Add Delivery Address to history view
-            "Extraction Time": order["extraction_time"]
-        })
-
-    # Reverse the order for chronological display (newest first).
-    display_data.reverse()
+if st.session_state.order_ids:
+    # The column deques are already newest first, so there is nothing to rebuild per rerun.
+    display_data = _build_history_table()
     
     st.dataframe(
         display_data, 
         use_container_width=True, 
-        column_order=("Order ID", "Internal Tracking No.", "Customer Name", "Order Date", "Total Amount", "Delivery Address", "Extraction Time"),
-        column_config={
-            "Total Amount": st.column_config.NumberColumn("Total Amount", format="¥%,d")
-        }
+        column_order=_HISTORY_COLUMN_ORDER,
+        column_config=_get_history_column_config()
     )
 else:
     st.info("No order information has been saved to the session yet.")
\ No newline at end of file